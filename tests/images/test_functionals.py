@@ -4,11 +4,16 @@ import unittest
 from tests.util import fix_seed, dummy_from_numpy, psnr
 from torch_staintools.functional.stain_extraction.macenko import MacenkoExtractor
 from torch_staintools.functional.stain_extraction.vahadane import VahadaneExtractor
-from torch_staintools.functional.optimization.dict_learning import get_concentrations
+from torch_staintools.functional.optimization.dict_learning import get_concentrations, dict_learning
+from torch_staintools.functional.optimization.solver import ista
+from torch_staintools.functional.stain_extraction.utils import percentile, _kth_smallest_topk
+from torch_staintools.functional.conversion.od import rgb2od
 from torch_staintools.functional.tissue_mask import get_tissue_mask, TissueMaskException
-from torch_staintools.functional.utility.implementation import transpose_trailing, img_from_concentration
+from torch_staintools.functional.utility.implementation import transpose_trailing, img_from_concentration, \
+    allow_tf32
 from torchvision.transforms.functional import convert_image_dtype
 from torch_staintools.normalizer.reinhard import ReinhardNormalizer
+from torch_staintools.normalizer.separation import StainSeparation
 import torch
 import cv2
 import os
@@ -99,6 +104,151 @@ class TestFunctional(unittest.TestCase):
         self.eval_wrapper(macenko)
         self.eval_wrapper(vahadane)
 
+    def test_batch_concentration(self):
+        device = TestFunctional.device
+        dummy_tensor_ubyte = TestFunctional.new_dummy_img_tensor_ubyte().to(device)
+        # a batch of different images: the original one, the horizontally flipped one, and one of which half is
+        # blanked to background, so that the solvers converge at different speeds for each image.
+        blanked = dummy_tensor_ubyte.clone()
+        blanked[..., :blanked.shape[-2] // 2, :] = 255
+        batch = torch.cat([dummy_tensor_ubyte, dummy_tensor_ubyte.flip(-1), blanked])
+        stain_matrix = MacenkoExtractor()(batch.clone(), luminosity_threshold=None)
+        for alg in ['ista', 'cd', 'ls']:
+            conc_batch = get_concentrations(batch.clone(), stain_matrix, algorithm=alg, regularizer=0.1)
+            for idx in range(batch.shape[0]):
+                conc_single = get_concentrations(batch[idx: idx + 1].clone(), stain_matrix[idx: idx + 1],
+                                                 algorithm=alg, regularizer=0.1)
+                self.assertTrue(torch.allclose(conc_batch[idx: idx + 1], conc_single, atol=1e-4))
+
+    def test_warm_start_concentration(self):
+        device = TestFunctional.device
+        dummy_tensor_ubyte = TestFunctional.new_dummy_img_tensor_ubyte().to(device)
+        stain_matrix = MacenkoExtractor()(dummy_tensor_ubyte.clone(), luminosity_threshold=None)
+        # cd runs to convergence: warm-starting from the solution returns the solution.
+        conc = get_concentrations(dummy_tensor_ubyte.clone(), stain_matrix, algorithm='cd', regularizer=0.1)
+        for _ in range(2):
+            conc_warm = get_concentrations(dummy_tensor_ubyte.clone(), stain_matrix, algorithm='cd', regularizer=0.1,
+                                           z0=conc)
+            self.assertTrue(torch.allclose(conc_warm, conc, atol=1e-4))
+            conc = conc_warm
+
+    def test_warm_start_cache(self):
+        device = TestFunctional.device
+        dummy_scaled = convert_image_dtype(TestFunctional.new_dummy_img_tensor_ubyte(), torch.float32).to(device)
+        normalizer = StainSeparation.build('macenko', concentration_method='cd', luminosity_threshold=None,
+                                           warm_start=True, device=device)
+        normalizer.fit(dummy_scaled)
+        normalizer(dummy_scaled)
+        stain_matrix = MacenkoExtractor()(dummy_scaled, luminosity_threshold=None)
+        # hit: same stain matrices and input shape
+        z0 = normalizer._warm_start_code(stain_matrix, dummy_scaled)
+        self.assertTrue(z0 is not None)
+        self.assertTrue(z0 is normalizer._last_z0)
+        # miss: different input shape or different stain matrices
+        cropped = dummy_scaled[..., :dummy_scaled.shape[-2] // 2, :]
+        self.assertTrue(normalizer._warm_start_code(stain_matrix, cropped) is None)
+        self.assertTrue(normalizer._warm_start_code(stain_matrix.flip(-2), dummy_scaled) is None)
+
+        # 'ls' takes no initialization: nothing is cached.
+        normalizer_ls = StainSeparation.build('macenko', concentration_method='ls', luminosity_threshold=None,
+                                              warm_start=True, device=device)
+        normalizer_ls.fit(dummy_scaled)
+        normalizer_ls(dummy_scaled)
+        self.assertTrue(normalizer_ls._last_z0 is None)
+        self.assertTrue(normalizer_ls._warm_start_code(stain_matrix, dummy_scaled) is None)
+
+    def test_ista_compile(self):
+        device = TestFunctional.device
+        g = torch.Generator(device).manual_seed(0)
+        weight = torch.rand(2, 3, 2, device=device, generator=g)
+        x = torch.rand(2, 64, 3, device=device, generator=g)
+        z0 = torch.zeros(2, 64, 2, device=device)
+        z = ista(x, z0, weight, alpha=0.1)
+        z_compiled = ista(x, z0, weight, alpha=0.1, use_compile=True)
+        self.assertTrue(torch.allclose(z_compiled, z, atol=1e-5))
+
+    def test_percentile(self):
+        g = torch.Generator().manual_seed(0)
+        for n in [1, 2, 3, 4, 5, 10, 101]:
+            t = torch.randn(2, n, 3, generator=g)
+            for q in [0, 1, 50, 99, 100]:
+                k = 1 + round(.01 * q * (n - 1))
+                self.assertTrue(torch.equal(_kth_smallest_topk(t, k, dim=1), t.kthvalue(k, dim=1).values))
+                self.assertTrue(torch.equal(percentile(t, q, dim=1), t.kthvalue(k, dim=1).values))
+        t = torch.randn(2, 10, 3, generator=g)
+        for q in [-1, 100.5]:
+            with self.assertRaises(AssertionError):
+                percentile(t, q, dim=1)
+        with self.assertRaises(AssertionError):
+            percentile(torch.empty(2, 0, 3), 50, dim=1)
+
+    def test_autocast_reconstruction(self):
+        device = TestFunctional.device
+        dummy_tensor_ubyte = TestFunctional.new_dummy_img_tensor_ubyte().to(device)
+        stain_matrix = MacenkoExtractor()(dummy_tensor_ubyte.clone(), luminosity_threshold=None)
+        concentration = get_concentrations(dummy_tensor_ubyte.clone(), stain_matrix, algorithm='ls')
+        c_transposed = transpose_trailing(concentration)
+        reconstructed = img_from_concentration(c_transposed, stain_matrix, dummy_tensor_ubyte.shape, (0, 1))
+        reconstructed_bf16 = img_from_concentration(c_transposed, stain_matrix, dummy_tensor_ubyte.shape, (0, 1),
+                                                    autocast_dtype=torch.bfloat16)
+        self.assertTrue(reconstructed_bf16.dtype == reconstructed.dtype)
+        # bfloat16 keeps 8 bits of mantissa
+        self.assertTrue(torch.allclose(reconstructed_bf16, reconstructed, atol=2e-2))
+
+    def test_allow_tf32(self):
+        prev = torch.backends.cuda.matmul.allow_tf32
+        try:
+            for flag in [False, True]:
+                torch.backends.cuda.matmul.allow_tf32 = flag
+                with allow_tf32(not flag):
+                    self.assertTrue(torch.backends.cuda.matmul.allow_tf32 == (not flag))
+                self.assertTrue(torch.backends.cuda.matmul.allow_tf32 == flag)
+                # restored even if the context exits by an exception
+                with self.assertRaises(RuntimeError):
+                    with allow_tf32(not flag):
+                        raise RuntimeError
+                self.assertTrue(torch.backends.cuda.matmul.allow_tf32 == flag)
+        finally:
+            torch.backends.cuda.matmul.allow_tf32 = prev
+
+    def test_rgb2od(self):
+        device = TestFunctional.device
+        dummy_tensor_ubyte = TestFunctional.new_dummy_img_tensor_ubyte().to(device)
+        dummy_tensor_ubyte[..., :8, :8] = 0
+        copied = dummy_tensor_ubyte.clone()
+        od = rgb2od(dummy_tensor_ubyte)
+        # zero intensity is treated as 1 without modifying the input
+        self.assertTrue(torch.equal(dummy_tensor_ubyte, copied))
+        self.assertTrue(torch.isfinite(od).all())
+        self.assertTrue(torch.allclose(od[..., :8, :8], -torch.log(torch.tensor(1 / 255, device=device))))
+
+    def test_batch_vahadane(self):
+        device = TestFunctional.device
+        dummy_tensor_ubyte = TestFunctional.new_dummy_img_tensor_ubyte().to(device)
+        # different # of tissue pixels in each image: partially blank the second one to background.
+        blanked = dummy_tensor_ubyte.flip(-1).clone()
+        blanked[..., :blanked.shape[-2] // 2, :] = 255
+        batch = torch.cat([dummy_tensor_ubyte, blanked])
+        vahadane = VahadaneExtractor()
+        stain_matrix = vahadane(batch.clone(), luminosity_threshold=0.8)
+        self.assertTrue(stain_matrix.shape == (batch.shape[0], 2, batch.shape[1]))
+        self.assertTrue(torch.allclose(stain_matrix.norm(dim=-1), torch.ones(1, device=device)))
+
+        # zero rows padded to the batch do not change the learned dictionary given the same initialization,
+        # if the number of valid rows is specified.
+        od = rgb2od(dummy_tensor_ubyte).flatten(start_dim=2).permute(0, 2, 1)[0]
+        num_samples = torch.tensor([od.shape[0]], device=device)
+        kwargs = dict(n_components=2, alpha=0.1, steps=10, device=device, progbar=False, persist=True, init='ridge')
+        for pad_ratio in [0.5, 2, 8]:
+            od_padded = torch.cat([od, od.new_zeros(int(od.shape[0] * pad_ratio), od.shape[1])])
+            for constrained in [True, False]:
+                dictionary, _ = dict_learning(od, rng=torch.Generator(device).manual_seed(0),
+                                              constrained=constrained, **kwargs)
+                dictionary_padded, _ = dict_learning(od_padded[None], rng=torch.Generator(device).manual_seed(0),
+                                                     constrained=constrained, num_samples=num_samples, **kwargs)
+                self.assertTrue(dictionary_padded.shape == (1,) + dictionary.shape)
+                self.assertTrue(torch.allclose(dictionary_padded[0], dictionary, atol=1e-5))
+
     def test_tissue_mask(self):
         device = TestFunctional.device
         dummy_scaled = convert_image_dtype(TestFunctional.new_dummy_img_tensor_ubyte(), torch.float32).to(device)
@@ -12,19 +12,17 @@ def rgb2od(image: torch.Tensor):
     RGB = 255 * exp(-1*OD_RGB) --> od_rgb = -1 * log(RGB / 255)
 
     Args:
-        image: Image RGB. Input scale does not matter.
+        image: Image RGB. Input scale does not matter. The input is not modified.
 
     Returns:
         Optical density RGB image.
     """
     # to [0, 255]
     image = convert_image_dtype(image, torch.uint8)
-    # device = image.device
-    # eps = torch.tensor(_eps_val).to(device)
-    eps = get_eps(image)
-    mask = (image == 0)
-    image[mask] = 1
-    return torch.maximum(-1 * torch.log(image / 255), eps)
+    # zero intensity is treated as 1 to avoid log(0). clamp rather than masked assignment so that the input
+    # (if already uint8) is not modified. The division allocates the only float tensor and the rest is in-place.
+    od = torch.div(image.clamp(min=1), 255).log_().neg_()
+    return od.clamp_min_(_eps_val)
 
 
 def od2rgb(OD: torch.Tensor):
@@ -2,136 +2,150 @@
 code directly adapted from https://github.com/rfeinman/pytorch-lasso
 """
 import warnings
-from .solver import coord_descent, ista
+from .solver import coord_descent, ista, fista
 from .sparse_util import initialize_code
 from ..conversion.od import rgb2od
-from ..utility.implementation import transpose_trailing
+from ..utility.implementation import transpose_trailing, allow_tf32
 from tqdm import tqdm
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
-from typing import Literal, get_args
+from typing import Literal, Optional, get_args
 from ..eps import get_eps
 # min_{D in C} = (1/n) sum_{i=1}^n (1/2)||x_i-Dalpha_i||_2^2 + lambda1||alpha_i||_1 + lambda1_2||alpha_i||_2^2
 METHOD_ISTA = Literal['ista']
+METHOD_FISTA = Literal['fista']
 METHOD_CD = Literal['cd']
 METHOD_LS = Literal['ls']
 
-METHOD_SPARSE = Literal[METHOD_ISTA, METHOD_CD]
+METHOD_SPARSE = Literal[METHOD_ISTA, METHOD_FISTA, METHOD_CD]
 METHOD_NON_SPARSE = Literal[METHOD_LS]
 
 METHOD_FACTORIZE = Literal[METHOD_SPARSE, METHOD_NON_SPARSE]
 
 _init_defaults = {
     get_args(METHOD_ISTA)[0]: 'zero',
+    get_args(METHOD_FISTA)[0]: 'zero',
     get_args(METHOD_CD)[0]: 'zero',
 }
 
-_batch_supported = {
-    get_args(METHOD_ISTA)[0]: False,
-    get_args(METHOD_CD)[0]: False,
-    get_args(METHOD_LS)[0]: True,
-}
 
+def lasso_loss(X: torch.Tensor, Z: torch.Tensor, weight: torch.Tensor, alpha: float = 1.0,
+               lambda1: float = 0.) -> torch.Tensor:
+    """Lasso loss definition for progress reporting.
+
+    1/2 sum(X - Z weight^T)^2 + lambda1 |weight|
 
-def lasso_loss(X: torch.Tensor, Z: torch.Tensor, weight: torch.Tensor, alpha: float = 1.0) -> torch.Tensor:
-    """Lasso loss definition.
+    The loss is only reported and never differentiated, so by default only the reconstruction error is computed.
+    The L2 term of the weight (lambda2 = 1e-9) is dropped as it is negligible.
 
-    sum(X-Z)^2 + lambda1 |weight| + (1-alpha) * |weight|2
+    Leading batch dimensions are supported and the loss is summed over the batch.
 
     Args:
-        X:
-        Z:
-        weight:
+        X: data (*, n_samples, n_features)
+        Z: code (*, n_samples, n_components)
+        weight: dictionary (*, n_features, n_components)
         alpha: for compatibility purpose. Not used.
+        lambda1: weight of the optional L1 term of the dictionary. Skipped if 0.
 
     Returns:
         lasso loss
     """
-    X_hat = torch.matmul(Z, weight.T)
-    lambda2 = 10e-10
-    lambda1 = 0.1
-    loss = 0.5 * (X - X_hat).norm(p=2).pow(2)\
-        + weight.norm(p=1) * lambda1 \
-        + lambda2 * weight.norm(p=2).pow(2)
-    return loss.mean()
+    X_hat = torch.matmul(Z, weight.mT)
+    # sum of squares directly, rather than sqrt (norm) followed by pow(2)
+    err = X - X_hat
+    loss = 0.5 * (err * err).sum()
+    if lambda1:
+        loss = loss + weight.abs().sum() * lambda1
+    return loss
 
 
 def update_dict(dictionary: torch.Tensor, x: torch.Tensor, code: torch.Tensor,
                 positive=True,
                 eps=1e-7, rng: torch.Generator = None):
     """
-    Update the dense dictionary factor in place.
+    Update the dense dictionary factor. All atoms are updated in a single vectorized step from the previous
+    dictionary, rather than one by one.
 
     Modified from `_update_dict` in sklearn.decomposition._dict_learning
 
+    Leading batch dimensions are supported, so that the dictionaries of a batch of independent problems are
+    updated at once.
 
     Args:
-        dictionary:  Tensor of shape (n_features, n_components) Value of the dictionary at the previous iteration.
-        x: Tensor of shape (n_samples, n_components)
-            Sparse coding of the data against which to optimize the dictionary.
-        code:  Tensor of shape (n_samples, n_components)
-            Sparse coding of the data against which to optimize the dictionary.
+        dictionary:  Tensor of shape (*, n_features, n_components) Value of the dictionary at the previous iteration.
+        x: Tensor of shape (*, n_samples, n_features)
+            Data matrix.
+        code:  Tensor of shape (*, n_samples, n_components)
+            Sparse coding of the data against which to optimize the dictionary. Coefficients of degenerate atoms
+            are set to zero in place.
         positive: Whether to enforce positivity when finding the dictionary.
         eps: Minimum vector norm before considering "degenerate"
         rng: torch.Generator for initialization of dictionary and code.
 
     Returns:
-
+        Updated dictionary in shape of (*, n_features, n_components). It is the transposed view of the contiguous
+        (*, n_components, n_features) atoms.
     """
-    n_components = dictionary.size(1)
-
-    # Residuals
-    R = x - torch.matmul(code, dictionary.T)  # (n_samples, n_features)
-    for k in range(n_components):
-        # Update k'th atom
-        R += torch.outer(code[:, k], dictionary[:, k])
-        dictionary[:, k] = torch.matmul(code[:, k], R)
-        if positive:
-            dictionary[:, k].clamp_(0, None)
-
-        # Re-scale k'th atom
-        atom_norm = dictionary[:, k].norm()
-        if atom_norm < eps:
-            dictionary[:, k].normal_(generator=rng)
-
-            if positive:
-                # if all negative then the clamped output will be zero vector.
-                # the division of zero vector to zero-norm --> nan
-                dictionary[:, k].clamp_(0, None)
-                dictionary[:, k] = dictionary[:, k].abs()
-            # another layer of protection
-            column_norm = dictionary[:, k].norm() + get_eps(dictionary)
-            dictionary[:, k] /= column_norm  # dictionary[:, k].norm()
-            # Set corresponding coefs to 0
-            code[:, k].zero_()  # TODO: is this necessary?
-        else:
-            dictionary[:, k] /= atom_norm
-            R -= torch.outer(code[:, k], dictionary[:, k])
-    return dictionary
-
-
-def update_dict_ridge(x, code, lambd=1e-4):
+    # gram matrix of the code and the projection of data on code, computed once instead of maintaining the
+    # (n_samples, n_features) residual per atom.
+    gram = torch.matmul(code.mT, code)  # (*, n_components, n_components)
+    code_x = torch.matmul(code.mT, x)  # (*, n_components, n_features)
+
+    # update all atoms at once (block update of the atoms in sklearn's `_update_dict` using the same previous
+    # dictionary) --> R^T code_k with R = x - code @ dictionary.T + outer(code_k, dictionary_k)
+    # atoms are stored as contiguous rows (*, n_components, n_features) and only transposed at the return.
+    dictionary_t = (code_x - torch.matmul(gram, dictionary.mT)
+                    + gram.diagonal(dim1=-2, dim2=-1).unsqueeze(-1) * dictionary.mT)
+    if positive:
+        dictionary_t.clamp_(0, None)
+
+    # Re-scale atoms. Compare the squared norm so that sqrt is only computed for the rescaling.
+    atom_sq_norm = (dictionary_t * dictionary_t).sum(dim=-1, keepdim=True)
+    degenerate = atom_sq_norm < eps * eps
+
+    # refill the degenerate atoms with random vectors (masked rather than branching on each atom's norm).
+    refill = torch.empty_like(dictionary_t).normal_(generator=rng)
+    if positive:
+        # if all negative then the clamped output will be zero vector.
+        # the division of zero vector to zero-norm --> nan
+        refill = refill.abs()
+    # another layer of protection
+    refill /= torch.linalg.vector_norm(refill, dim=-1, keepdim=True) + get_eps(refill)
+    dictionary_t = torch.where(degenerate, refill, dictionary_t / atom_sq_norm.sqrt().clamp_min(eps))
+    # Set corresponding coefs to 0
+    code.masked_fill_(degenerate.mT, 0)  # TODO: is this necessary?
+    return dictionary_t.mT
+
+
+def update_dict_ridge(x, code, lambd=1e-4, num_samples: Optional[torch.Tensor] = None):
     """Update an (unconstrained) dictionary with ridge regression
 
     This is equivalent to a Newton step with the (L2-regularized) squared
     error objective:
     f(V) = (1/2N) * ||Vz - x||_2^2 + (lambd/2) * ||V||_2^2
 
+    Leading batch dimensions are supported, so that the K x K systems of all batch items are solved by
+    a single batched Cholesky factorization.
+
     Args:
-        x:  a batch of observations with shape (n_samples, n_features)
-        code: (z) a batch of code vectors with shape (n_samples, n_components)
+        x:  a batch of observations with shape (*, n_samples, n_features)
+        code: (z) a batch of code vectors with shape (*, n_samples, n_components)
         lambd:  weight decay parameter
+        num_samples: Optional number of valid (non-padded) rows of each batch item (*,), so that zero rows padded
+            to n_samples are not counted in the weight decay. n_samples if not specified.
 
     Returns:
-
+        Updated dictionary in shape of (*, n_features, n_components)
     """
 
-    rhs = torch.mm(code.T, x)
-    M = torch.mm(code.T, code)
-    M.diagonal().add_(lambd * x.size(0))
+    rhs = torch.matmul(code.mT, x)
+    M = torch.matmul(code.mT, code)
+    if num_samples is None:
+        M.diagonal(dim1=-2, dim2=-1).add_(lambd * x.size(-2))
+    else:
+        M.diagonal(dim1=-2, dim2=-1).add_(lambd * torch.as_tensor(num_samples, device=M.device)[..., None])
     L = torch.linalg.cholesky(M)
-    V = torch.cholesky_solve(rhs, L).T
+    V = torch.cholesky_solve(rhs, L).mT
 
     return V
 
@@ -145,13 +159,13 @@ def dict_evaluate(x: torch.Tensor, weight: torch.Tensor, alpha: float, rng: torc
 
 def sparse_encode(x: torch.Tensor, weight: torch.Tensor, alpha: float = 0.1,
                   z0=None, algorithm: METHOD_SPARSE = 'ista', init=None, rng: torch.Generator = None,
+                  num_samples: Optional[torch.Tensor] = None,
                   **kwargs):
-    n_samples = x.size(0)
-    n_components = weight.size(1)
+    n_components = weight.size(-1)
 
     # initialize code variable
     if z0 is not None:
-        assert z0.shape == (n_samples, n_components)
+        assert z0.shape == x.shape[:-1] + (n_components,)
     else:
         if init is None:
             init = _init_defaults.get(algorithm, 'zero')
@@ -162,9 +176,12 @@ def sparse_encode(x: torch.Tensor, weight: torch.Tensor, alpha: float = 0.1,
     # perform inference
     match algorithm:
         case 'cd':
+            # the convergence test of cd is per sample: not affected by the padded rows.
             z = coord_descent(x, weight, z0, alpha, **kwargs)
         case 'ista':
-            z = ista(x, z0, weight, alpha, rng=rng, **kwargs)
+            z = ista(x, z0, weight, alpha, rng=rng, num_samples=num_samples, **kwargs)
+        case 'fista':
+            z = fista(x, z0, weight, alpha, rng=rng, num_samples=num_samples, **kwargs)
         case _:
             raise ValueError("invalid algorithm parameter '{}'.".format(algorithm))
     return z
@@ -172,23 +189,63 @@ def sparse_encode(x: torch.Tensor, weight: torch.Tensor, alpha: float = 0.1,
 
 def dict_learning(x, n_components, *, alpha=1.0, constrained=True, persist=False,
                   lambd=1e-2, steps=60, device='cpu', progbar=True, rng: torch.Generator = None,
+                  tf32: bool = False, num_samples: Optional[torch.Tensor] = None,
                   **solver_kwargs):
-    n_samples, n_features = x.shape
+    """Dictionary learning by alternating the sparse coding and the dictionary update.
+
+    Leading batch dimensions of `x` are supported, so that a batch of independent problems (e.g., the OD vectors
+    of multiple images) shares all `steps` iterations. Problems with fewer samples can be padded with zero rows
+    and specify their number of valid rows by `num_samples`: with zero-valued code initializations (e.g., `zero`,
+    `ridge`, or `transpose`), the zero rows have zero codes and contribute nothing to the loss or the dictionary
+    update, and `num_samples` excludes them from the convergence test of the solver and the weight decay of the
+    unconstrained (ridge) update.
+
+    Args:
+        x: data in shape of (*, n_samples, n_features)
+        n_components: number of atoms in the dictionary.
+        alpha: sparse penalty of the code.
+        constrained: whether to force the dictionary to be positive with unit-norm atoms.
+        persist: whether to warm-start the sparse coding by the code of the previous step.
+        lambd: weight decay of the unconstrained (ridge) dictionary update.
+        steps: number of iterations.
+        device: device to perform the computation.
+        progbar: whether to display the progress bar.
+        rng: torch.Generator for random initializations.
+        tf32: whether to allow TF32 matmul during the iterations on CUDA. Faster on GPUs with tensor cores, but
+            the matmul then rounds its inputs to a 10-bit mantissa, so the learned dictionary may differ from the
+            float32 result. Default False.
+        num_samples: Optional number of valid (non-padded) rows of each problem in shape of (*,).
+            n_samples if not specified.
+        **solver_kwargs: other keyword arguments passed to `sparse_encode`.
+
+    Returns:
+        dictionary in shape of (*, n_features, n_components) and the loss of each step (summed over the batch).
+    """
+    n_samples, n_features = x.shape[-2:]
+    batch_shape = x.shape[:-2]
     x = x.to(device)
 
-    weight = torch.randn(n_features, n_components, device=device, generator=rng)
-    nn.init.orthogonal_(weight)
-    # l2(w)
-    if constrained:
-        weight = F.normalize(weight, dim=0)
+    # orthogonal initialization by the QR of a random matrix on the device (nn.init.orthogonal_ only treats 2D
+    # matrices, one at a time). The QR is taken on the taller side, so that either the atoms (columns) are
+    # orthonormal, or, if n_components > n_features, the rows are.
+    flip = n_components > n_features
+    rand_shape = (n_components, n_features) if flip else (n_features, n_components)
+    q, r = torch.linalg.qr(torch.randn(*batch_shape, *rand_shape, device=device, generator=rng))
+    # sign correction as nn.init.orthogonal_ so that the result is uniformly distributed.
+    q = q * r.diagonal(dim1=-2, dim2=-1).sign().unsqueeze(-2)
+    weight = q.mT if flip else q
+    # l2(w). the atoms are already of unit norm unless flipped.
+    if constrained and flip:
+        weight = F.normalize(weight, dim=-2)
     Z0 = None
 
     losses = torch.zeros(steps, device=device)
-    with tqdm(total=steps, disable=not progbar) as progress_bar:
+    # opt-in TF32 matmul (if supported by the GPU) rounds the matmul inputs to a 10-bit mantissa.
+    with tqdm(total=steps, disable=not progbar) as progress_bar, allow_tf32(tf32):
         for i in range(steps):
             # infer sparse coefficients and compute loss
 
-            Z = sparse_encode(x, weight, alpha, Z0, rng=rng, **solver_kwargs)
+            Z = sparse_encode(x, weight, alpha, Z0, rng=rng, num_samples=num_samples, **solver_kwargs)
             losses[i] = lasso_loss(x, Z, weight, alpha)
             if persist:
                 Z0 = Z
@@ -197,50 +254,17 @@ def dict_learning(x, n_components, *, alpha=1.0, constrained=True, persist=False
             if constrained:
                 weight = update_dict(weight, x, Z, positive=True, rng=rng)
             else:
-                weight = update_dict_ridge(x, Z, lambd=lambd)
+                weight = update_dict_ridge(x, Z, lambd=lambd, num_samples=num_samples)
 
-            # update progress bar
-            progress_bar.set_postfix(loss=losses[i].item())
+            # update progress bar. Reading the loss back to host synchronizes with the device in every step,
+            # so skip it if the progress bar is not displayed.
+            if progbar:
+                progress_bar.set_postfix(loss=losses[i].item())
             progress_bar.update(1)
 
     return weight, losses
 
 
-def get_concentrations_single(od_flatten, stain_matrix, regularizer=0.01, method: METHOD_FACTORIZE = 'ista',
-                              rng: torch.Generator = None):
-    """Helper function to estimate concentration matrix given an image and stain matrix with shape: 2 x (H*W)
-
-    For solvers without batch support. Inputs are individual data points from a batch
-
-    Args:
-        od_flatten: Flattened optical density vectors in shape of (H*W) x C (H and W dimensions flattened).
-        stain_matrix: the computed stain matrices in shape of num_stain x input channel
-        regularizer: regularization term if ISTA algorithm is used
-        method: which method to compute the concentration: coordinate descent ('cd') or iterative-shrinkage soft
-            thresholding algorithm ('ista')
-        rng: torch.Generator for random initializations
-    Returns:
-        computed concentration: num_stains x num_pixel_in_tissue_mask
-    """
-    match method:
-        case 'cd':
-            return coord_descent(od_flatten, stain_matrix.T, alpha=regularizer).T  # figure out pylasso equivalent
-        case 'ista':
-            return ista(od_flatten, 'ridge', stain_matrix.T, alpha=regularizer, rng=rng).T
-        case 'frobenium':
-            return torch.linalg.lstsq(stain_matrix.T, od_flatten.T)[0].T
-
-    raise NotImplementedError(f"{method} is not a valid optimizer")
-
-
-def get_concentration_one_by_one(od_flatten, stain_matrix, regularizer, algorithm, rng):
-    result = list()
-    for od_single, stain_mat_single in zip(od_flatten, stain_matrix):
-        result.append(get_concentrations_single(od_single, stain_mat_single, regularizer, algorithm, rng=rng))
-    # get_concentrations_helper(od_flatten, stain_matrix, regularizer, method)
-    return torch.stack(result)
-
-
 def _ls_batch(od_flatten, stain_matrix):
     """Use least square to solve the factorization for concentration.
 
@@ -258,21 +282,45 @@ def _ls_batch(od_flatten, stain_matrix):
     return torch.linalg.lstsq(transpose_trailing(stain_matrix), transpose_trailing(od_flatten))[0]
 
 
-def get_concentration_batch(od_flatten, stain_matrix, regularizer, algorithm, rng):
-    assert algorithm in _batch_supported
-    if not _batch_supported[algorithm]:
-        return get_concentration_one_by_one(od_flatten, stain_matrix, regularizer, algorithm, rng)
+def get_concentration_batch(od_flatten, stain_matrix, regularizer, algorithm, rng, z0=None):
+    """Helper function to estimate concentration matrix given a batch of OD vectors and stain matrices.
+
+    All solvers treat the batch as the leading dimension, so the whole batch is solved at once.
+
+    Args:
+        od_flatten: Flattened optical density vectors in shape of B x (H*W) x C (H and W dimensions flattened).
+        stain_matrix: the computed stain matrices in shape of B x num_stain x input channel
+        regularizer: regularization term if ISTA algorithm is used
+        algorithm: which method to compute the concentration: coordinate descent ('cd'),
+            iterative-shrinkage soft thresholding algorithm ('ista'), 'fista' (an explicit alias of 'ista', which
+            already applies the FISTA momentum by default), or least square ('ls').
+        rng: torch.Generator for random initializations
+        z0: Optional initial concentration (warm start) in shape of B x num_stains x (H*W) for sparse solvers.
+            If not specified, ista/fista are initialized by the ridge solution and cd by zeros. Ignored by 'ls'.
+    Returns:
+        computed concentration: B x num_stains x num_pixel_in_tissue_mask
+    """
+    code_init = transpose_trailing(z0) if z0 is not None else None
     match algorithm:
+        case 'cd':
+            return transpose_trailing(coord_descent(od_flatten, transpose_trailing(stain_matrix), z0=code_init,
+                                                    alpha=regularizer))
+        case 'ista':
+            code_init = code_init if code_init is not None else 'ridge'
+            return transpose_trailing(ista(od_flatten, code_init, transpose_trailing(stain_matrix),
+                                           alpha=regularizer, rng=rng))
+        case 'fista':
+            code_init = code_init if code_init is not None else 'ridge'
+            return transpose_trailing(fista(od_flatten, code_init, transpose_trailing(stain_matrix),
+                                            alpha=regularizer, rng=rng))
         case 'ls':
             return _ls_batch(od_flatten, stain_matrix)
-        case _:
-            ...
 
-    raise NotImplementedError('Currently only least-square (ls) is implemented as batch concentration solver')
+    raise NotImplementedError(f"{algorithm} is not a valid optimizer")
 
 
 def get_concentrations(image, stain_matrix, regularizer=0.01, algorithm: METHOD_FACTORIZE = 'ista',
-                       rng: torch.Generator = None):
+                       rng: torch.Generator = None, z0: Optional[torch.Tensor] = None):
     """Estimate concentration matrix given an image and stain matrix.
 
     Warnings:
@@ -283,9 +331,12 @@ def get_concentrations(image, stain_matrix, regularizer=0.01, algorithm: METHOD_
         stain_matrix: B x num_stain x input channel
         regularizer: regularization term if ISTA algorithm is used
         algorithm: which method to compute the concentration: Solve min||HExC - OD||p
-            support 'ista', 'cd', and 'ls'. 'ls' simply solves the least square problem for factorization of
-            min||HExC - OD||F (Frobenius norm) but is faster. 'ista'/cd enforce the sparse penalty (L1 norm) but slower.
+            support 'ista', 'fista', 'cd', and 'ls'. 'ls' simply solves the least square problem for factorization of
+            min||HExC - OD||F (Frobenius norm) but is faster. 'ista'/'fista'/cd enforce the sparse penalty (L1 norm)
+            but slower.
         rng: torch.Generator for random initializations
+        z0: Optional initial concentration (warm start) in shape of B x num_stains x (H*W), e.g., a previously
+            computed concentration. Only used by the sparse solvers (ista/fista/cd).
     Returns:
         concentration matrix: B x num_stains x num_pixel_in_tissue_mask
     """
@@ -295,4 +346,6 @@ def get_concentrations(image, stain_matrix, regularizer=0.01, algorithm: METHOD_
     od = rgb2od(image).to(device)
     # B (H*W) C
     od_flatten = od.flatten(start_dim=2, end_dim=-1).permute(0, 2, 1)
-    return get_concentration_batch(od_flatten, stain_matrix, regularizer, algorithm, rng)
+    if z0 is not None:
+        z0 = z0.to(device)
+    return get_concentration_batch(od_flatten, stain_matrix, regularizer, algorithm, rng, z0=z0)
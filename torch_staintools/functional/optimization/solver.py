@@ -1,106 +1,191 @@
 """
 code directly adapted from https://github.com/rfeinman/pytorch-lasso
 """
-from scipy.sparse.linalg import eigsh
+import math
 import torch
 from .sparse_util import initialize_code
 from ..eps import get_eps
 import torch.nn.functional as F
-import numpy as np
+from typing import Tuple, Callable, Optional
+from functools import lru_cache
+
+
+def _cd_update(z: torch.Tensor, b: torch.Tensor, S: torch.Tensor, offset: torch.Tensor,
+               alpha: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    """One step of coordinate descent. Only the coordinate with the largest change is updated for each sample.
+
+    Samples of all batch items are flattened into rows, and the rows of S of all batch items are stacked.
+
+    Args:
+        z: code. [R,K]
+        b: [R,K]
+        S: I - W^T @ W of all batch items stacked. [B*K,K]
+        offset: index of the first row of the corresponding S of each sample, i.e., batch index * K. [R]
+        alpha: threshold of shrinkage.
+
+    Returns:
+        updated z and b
+    """
+    z_next = F.softshrink(b, alpha)  # [R,K]
+    z_diff = z_next - z  # [R,K]
+    kk = z_diff.abs().argmax(-1, keepdim=True)  # [R,1]
+    # S is symmetric: the k-th row is the k-th column.
+    b = b + S.index_select(0, offset + kk.squeeze(-1)) * z_diff.gather(-1, kk)  # [R,K] += [R,K] * [R,1]
+    z = z.scatter(-1, kk, z_next.gather(-1, kk))
+    return z, b
+
+
+def _ista_step(y: torch.Tensor, A: torch.Tensor, c: torch.Tensor, thresh: float) -> torch.Tensor:
+    """One step of ISTA: gradient descent of the 1/2 ||Wz - x||^2 followed by the soft thresholding.
+
+    The gradient step y - lr * (y W^T W - x W) is linear in y, and is precomputed as y A + c with A = I - lr W^T W
+    and c = lr x W, so that each step is a single (N x K) @ (K x K) matmul and an addition.
+
+    Args:
+        y: code. (B, N, K)
+        A: I - lr W^T W. (B, K, K)
+        c: lr x W. (B, N, K)
+        thresh: threshold of shrinkage.
+
+    Returns:
+        updated code
+    """
+    return F.softshrink(torch.bmm(y, A).add_(c), thresh)
+
+
+@lru_cache(maxsize=None)
+def _compiled(fn: Callable) -> Callable:
+    """Lazily torch.compile the iteration kernel so that the elementwise tail is fused with the matmul.
+
+    Compiled with dynamic shapes so that inputs of different sizes (e.g., number of pixels) do not trigger
+    recompilation.
+    """
+    return torch.compile(fn, dynamic=True)
 
 
 def coord_descent(x, W, z0=None, alpha=1.0, lambda1=0.01, maxiter=1000, tol=1e-6, verbose=False):
-    """ modified coord_descent"""
-    input_dim, code_dim = W.shape  # [D,K]
-    batch_size, input_dim1 = x.shape  # [N,D]
+    """ modified coord_descent
+
+    Leading batch dimensions are supported: x in shape of [*, N, D], W in shape of [*, D, K] and the output code
+    in shape of [*, N, K]. The samples of all batch items are solved together as rows of an [R, K] problem.
+    """
+    input_dim, code_dim = W.shape[-2:]  # [D,K]
+    input_dim1 = x.shape[-1]  # [N,D]
     assert input_dim1 == input_dim
     tol = tol * code_dim
     if z0 is None:
-        z = x.new_zeros(batch_size, code_dim)  # [N,K]
+        z = x.new_zeros(*x.shape[:-1], code_dim)  # [N,K]
     else:
-        assert z0.shape == (batch_size, code_dim)
+        assert z0.shape == x.shape[:-1] + (code_dim,)
         z = z0
 
-    # initialize b
-    # TODO: how should we initialize b when 'z0' is provided?
-    b = torch.mm(x, W)  # [N,K]
-
     # precompute S = I - W^T @ W
-    S = - torch.mm(W.T, W)  # [K,K]
-    S.diagonal().add_(1.)
+    S = - torch.matmul(W.mT, W)  # [K,K]
+    S.diagonal(dim1=-2, dim2=-1).add_(1.)
+
+    # initialize b. The update keeps b = x @ W + z @ S, so that z = softshrink(b) at convergence. a provided z0
+    # must be accounted for in b as well.
+    b = torch.matmul(x, W)  # [N,K]
+    if z0 is not None:
+        b = b + torch.matmul(z, S)
 
     def fn(z):
-        x_hat = torch.matmul(W, z.T)
+        x_hat = torch.matmul(z, W.mT)
         loss = 0.5 * (x - x_hat).norm(p=2).pow(2) + z.norm(p=1) * lambda1
         return loss
 
-    def cd_update(z, b):
-        z_next = F.softshrink(b, alpha)  # [N,K]
-        z_diff = z_next - z  # [N,K]
-        k = z_diff.abs().argmax(1)  # [N]
-        kk = k.unsqueeze(1)  # [N,1]
-        b = b + S[:, k].T * z_diff.gather(1, kk)  # [N,K] += [N,K] * [N,1]
-        z = z.scatter(1, kk, z_next.gather(1, kk))
-        return z, b
+    # flatten the samples of all batch items into rows. Each row finds its S by the offset of its batch item.
+    out_shape = b.shape
+    num_samples = out_shape[-2]
+    b = b.reshape(-1, code_dim)
+    z = z.expand(out_shape).reshape(-1, code_dim)
+    S_stacked = S.expand(*out_shape[:-2], code_dim, code_dim).reshape(-1, code_dim)
+    offset = torch.arange(b.shape[0] // num_samples, device=W.device).repeat_interleave(num_samples) * code_dim
 
-    active = torch.arange(batch_size, device=W.device)
+    # active set of rows as in the original implementation. The working tensors are only compacted in the
+    # iterations wherein some rows converge.
+    active = torch.arange(b.shape[0], device=W.device)
+    z_active, b_active = z, b
     for i in range(maxiter):
         if len(active) == 0:
             break
-        z_old = z[active]
-        z_new, b[active] = cd_update(z_old, b[active])
-        update = (z_new - z_old).abs().sum(1)
-        z[active] = z_new
-        active = active[update > tol]
+        z_new, b_new = _cd_update(z_active, b_active, S_stacked, offset, float(alpha))
+        update = (z_new - z_active).abs().sum(-1)
+        keep = update > tol
+        if keep.all():
+            z_active, b_active = z_new, b_new
+        else:
+            # boolean masks to indices once, shared by all the tensors to compact.
+            drop_idx = (~keep).nonzero().squeeze(-1)
+            keep_idx = keep.nonzero().squeeze(-1)
+            b.index_copy_(0, active.index_select(0, drop_idx), b_new.index_select(0, drop_idx))
+            active, offset = active.index_select(0, keep_idx), offset.index_select(0, keep_idx)
+            z_active, b_active = z_new.index_select(0, keep_idx), b_new.index_select(0, keep_idx)
         if verbose:
-            print('iter %i - loss: %0.4f' % (i, fn(F.softshrink(b, alpha))))
+            b.index_copy_(0, active, b_active)
+            print('iter %i - loss: %0.4f' % (i, fn(F.softshrink(b.reshape(out_shape), alpha))))
+    b.index_copy_(0, active, b_active)
 
-    z = F.softshrink(b, alpha)
+    z = F.softshrink(b.reshape(out_shape), alpha)
 
     return z
 
 
-def _lipschitz_constant(W):
+def _lipschitz_constant(W, WtW=None):
     """find the Lipscitz constant to compute the learning rate in ISTA
 
     Args:
-        W: weights w in f(z) = ||Wz - x||^2
+        W: weights w in f(z) = ||Wz - x||^2. Leading batch dimensions are supported (* x D x K).
+        WtW: precomputed W^T @ W (* x K x K). Computed from W if not specified.
 
     Returns:
-
+        Lipschitz constant in shape of (*, 1, 1) so that it broadcasts over the code (* x N x K).
     """
     # L = torch.linalg.norm(W, ord=2) ** 2
     # W has nan
-    WtW = torch.matmul(W.t(), W)
-    WtW += torch.eye(WtW.size(0)).to(W.device) * get_eps(WtW)
-    # L = torch.linalg.eigvalsh(WtW)[-1]
-    # scipy.sparse.linalg._eigen.arpack.arpack.ArpackError: ARPACK error 3: No shifts could be applied during
-    # a cycle of the Implicitly restarted Arnoldi iteration.
-    # One possibility is to increase the size of NCV relative to NEV.
-
-    L = eigsh(WtW.detach().cpu().numpy(), k=1, which='LM', return_eigenvectors=False).item()
-    if not np.isfinite(L):  # sometimes L is not finite because of potential cublas error.
-        L = torch.linalg.norm(W, ord=2) ** 2
-    return L
+    if WtW is None:
+        WtW = torch.matmul(W.mT, W)
+    WtW = WtW + torch.eye(WtW.size(-1), device=W.device) * get_eps(WtW)
+    # a batched eigen decomposition of the K x K gram matrices instead of one scipy ARPACK (eigsh) call per image.
+    L = torch.linalg.eigvalsh(WtW)[..., -1]
+    # sometimes L is not finite because of potential cublas error.
+    finite = torch.isfinite(L)
+    if not finite.all():
+        # the spectral norm (an SVD) only for the failed entries.
+        L = L.clone()
+        L[~finite] = torch.linalg.matrix_norm(W[~finite], ord=2) ** 2
+    return L[..., None, None]
 
 
 def ista(x, z0, weight, alpha=1.0, fast=True, lr='auto', maxiter=50,
-         tol=1e-5, lambda1=0.01, verbose=False, rng: torch.Generator = None):
+         tol=1e-5, lambda1=0.01, verbose=False, rng: torch.Generator = None,
+         WtW: torch.Tensor = None, Wty: torch.Tensor = None, use_compile: bool = False,
+         num_samples: Optional[torch.Tensor] = None):
     """ISTA solver
 
+    Leading batch dimensions are supported, so that a batch of images is solved in one pass. The convergence test
+    is performed per batch item: converged items take their last update and are removed from the iterations, so
+    that the result of each item does not depend on the rest of the batch.
+
     Args:
-        x: data
-        z0: code, or the initialization mode of the code.
-        weight: dict
+        x: data. (*, N, D)
+        z0: code, or the initialization mode of the code. (*, N, K)
+        weight: dict. (*, D, K)
         alpha: eps term for code initialization
         fast: whether to use FISTA (fast-ista) instead of ISTA
         lr: learning rate/step size. If `auto` then it will be specified by
             the Lipschitz constant of f(z) = ||Wz - x||^2
         maxiter: max number of iteration if not converge.
-        tol: tolerance term of convergence test.
+        tol: tolerance term of convergence test. Scaled by N * K of each batch item.
         lambda1: lambda of the sparse terms.
         verbose: whether to print the progress
         rng: torch.Generator for random initialization
+        WtW: Optional precomputed weight^T @ weight (*, K, K). Computed once before the iterations if not given.
+        Wty: Optional precomputed x @ weight (*, N, K). Computed once before the iterations if not given.
+        use_compile: whether to torch.compile the iteration kernel. Note that the compilation itself takes time in
+            the first call. Only available by calling the solver directly.
+        num_samples: Optional number of valid rows of each batch item (*,), if the items are padded to N by zero
+            rows. Only the valid rows are counted in the tolerance. N if not specified.
 
     Returns:
 
@@ -108,47 +193,138 @@ def ista(x, z0, weight, alpha=1.0, fast=True, lr='auto', maxiter=50,
     if type(z0) is str:
         z0 = initialize_code(x, weight, alpha, z0, rng=rng)
 
+    # the gradient W^T(Wz - x) only depends on z through W^T W. Precompute once.
+    if WtW is None:
+        WtW = torch.matmul(weight.mT, weight)
+    if Wty is None:
+        Wty = torch.matmul(x, weight)
+
     if lr == 'auto':
         # set lr based on the maximum eigenvalue of W^T @ W; i.e. the
         # Lipschitz constant of \grad f(z), where f(z) = ||Wz - x||^2
-        L = _lipschitz_constant(weight)
+        L = _lipschitz_constant(weight, WtW)
         lr = 1 / L
-    tol = z0.numel() * tol
+    lr = torch.as_tensor(lr, dtype=z0.dtype, device=z0.device)
 
-    def loss_fn(z_k):
-        x_hat = torch.matmul(weight, z_k.T)
-        loss = 0.5 * (x.T - x_hat).norm(p=2).pow(2) + z_k.norm(p=1) * lambda1
+    # all batch dimensions are flattened into one: (B, N, K).
+    batch_shape = z0.shape[:-2]
+    n_rows, code_dim = z0.shape[-2:]
+    z0 = z0.reshape(-1, n_rows, code_dim)
+    batch_size = z0.shape[0]
+    lr = lr.expand(*batch_shape, 1, 1).reshape(batch_size, 1, 1)
+
+    # the threshold alpha * lr differs among batch items. Iterate u = z / (alpha * lr) instead, which is shrunk by
+    # the same threshold 1 for all items, so that F.softshrink (with a float threshold) applies to the whole batch.
+    if alpha > 0:
+        scale, thresh = alpha * lr, 1.
+    else:
+        scale, thresh = torch.ones_like(lr), 0.
+    # u_next = softshrink(u - lr * (u W^T W - x W / scale)) = softshrink(u A + c)
+    WtW = WtW.expand(*batch_shape, code_dim, code_dim).reshape(batch_size, code_dim, code_dim)
+    Wty = Wty.expand(*batch_shape, n_rows, code_dim).reshape(batch_size, n_rows, code_dim)
+    A = torch.eye(code_dim, dtype=z0.dtype, device=z0.device) - lr * WtW
+    c = Wty * (lr / scale)
+
+    # per batch item. Zero-padded rows (with zero codes) do not change and are excluded from the tolerance.
+    # |z - z_next| = scale * |u - u_next|
+    if num_samples is None:
+        num_samples = torch.full((), n_rows, device=z0.device)
+    num_samples = torch.as_tensor(num_samples, device=z0.device).expand(batch_shape).reshape(batch_size)
+    tol = num_samples * (code_dim * tol) / scale.reshape(batch_size)
+
+    ista_step = _compiled(_ista_step) if use_compile else _ista_step
+
+    def loss_fn(z_k, idx):
+        x_k = x.expand(*batch_shape, *x.shape[-2:]).reshape(batch_size, *x.shape[-2:])[idx]
+        w_k = weight.expand(*batch_shape, *weight.shape[-2:]).reshape(batch_size, *weight.shape[-2:])[idx]
+        x_hat = torch.matmul(z_k, w_k.mT)
+        loss = 0.5 * (x_k - x_hat).norm(p=2).pow(2) + z_k.norm(p=1) * lambda1
         return loss
 
-    def rss_grad(z_k):
-        resid = torch.matmul(z_k, weight.T) - x
-        return torch.matmul(resid, weight)
     # optimize
-    z = z0
+    z = z0 / scale
     if fast:
-        y, t = z0, torch.tensor(1, dtype=torch.float32).to(z0.device)
+        y, t = z, 1.
+    # indices of the batch items still in the iterations. The output is only allocated once some items converge
+    # before the others.
+    active = torch.arange(batch_size, device=z0.device)
+    out = None
     for _ in range(maxiter):
         if verbose:
-            print('loss: %0.4f' % loss_fn(z), "weight:", weight, "lr:", lr, "z:", z)
+            print('loss: %0.4f' % loss_fn(z * scale, active), "weight:", weight, "lr:", lr, "z:", z * scale)
         # ista update
         z_prev = y if fast else z
         try:
-            z_next = F.softshrink(z_prev - lr * rss_grad(z_prev), alpha * lr)
+            z_next = ista_step(z_prev, A, c, thresh)
         except RuntimeError as e:
             print(e)
             print('lr error ', lr, 'did not update z')
             z_next = z_prev  # if there is a failure just reset state.
 
-        # check convergence
-        if (z - z_next).abs().sum() <= tol:
-            z = z_next
-            break
+        # check convergence of each batch item. Converged items take the last update.
+        z_diff = z_next - z
+        converged = z_diff.abs().sum(dim=(-2, -1)) <= tol
 
         # update variables
         if fast:
-            t_next = (1 + torch.sqrt(1 + 4 * t ** 2)) / 2
-            y = z_next + ((t - 1) / t_next) * (z_next - z)
+            t_next = (1 + math.sqrt(1 + 4 * t ** 2)) / 2
+            y = torch.add(z_next, z_diff, alpha=(t - 1) / t_next)
             t = t_next
         z = z_next
 
-    return z
+        num_converged = int(converged.sum())
+        if num_converged == 0:
+            continue
+        if num_converged == len(active) and out is None:
+            break
+        # write the converged items to the output and only keep the others in the iterations.
+        if out is None:
+            out = torch.empty_like(z)
+        out[active[converged]] = z[converged] * scale[converged]
+        keep = ~converged
+        active = active[keep]
+        if len(active) == 0:
+            break
+        z, A, c, scale, tol = z[keep], A[keep], c[keep], scale[keep], tol[keep]
+        if fast:
+            y = y[keep]
+
+    if out is None:
+        out = z * scale
+    elif len(active) > 0:
+        out[active] = z * scale
+    return out.reshape(*batch_shape, n_rows, code_dim)
+
+
+def fista(x, z0, weight, alpha=1.0, lr='auto', maxiter=50,
+          tol=1e-5, lambda1=0.01, verbose=False, rng: torch.Generator = None,
+          WtW: torch.Tensor = None, Wty: torch.Tensor = None, use_compile: bool = False,
+          num_samples: Optional[torch.Tensor] = None):
+    """FISTA solver. An explicit alias of `ista` with `fast=True`, which is already the default of `ista`.
+
+    The momentum y_k = z_k + ((t_{k-1} - 1) / t_k) (z_k - z_{k-1}) is applied by both 'ista' and 'fista' unless
+    `ista` is called with `fast=False`. See `ista` for details of the arguments.
+
+    Args:
+        x: data. (*, N, D)
+        z0: code, or the initialization mode of the code. (*, N, K)
+        weight: dict. (*, D, K)
+        alpha: eps term for code initialization
+        lr: learning rate/step size. If `auto` then it will be specified by
+            the Lipschitz constant of f(z) = ||Wz - x||^2
+        maxiter: max number of iteration if not converge.
+        tol: tolerance term of convergence test.
+        lambda1: lambda of the sparse terms.
+        verbose: whether to print the progress
+        rng: torch.Generator for random initialization
+        WtW: Optional precomputed weight^T @ weight (*, K, K).
+        Wty: Optional precomputed x @ weight (*, N, K).
+        use_compile: whether to torch.compile the iteration kernel. Only available by calling the solver directly.
+        num_samples: Optional number of valid (non-padded) rows of each batch item (*,).
+
+    Returns:
+
+    """
+    return ista(x, z0, weight, alpha=alpha, fast=True, lr=lr, maxiter=maxiter, tol=tol, lambda1=lambda1,
+                verbose=verbose, rng=rng, WtW=WtW, Wty=Wty, use_compile=use_compile,
+                num_samples=num_samples)
@@ -3,13 +3,13 @@ import torch
 
 def ridge(b: torch.Tensor, A: torch.Tensor, alpha: float = 1e-4):
     # right-hand side
-    rhs = torch.matmul(A.T, b)
+    rhs = torch.matmul(A.mT, b)
     # regularized gram matrix
-    M = torch.matmul(A.T, A)
-    M.diagonal().add_(alpha)
+    M = torch.matmul(A.mT, A)
+    M.diagonal(dim1=-2, dim2=-1).add_(alpha)
     # solve
     L, info = torch.linalg.cholesky_ex(M)
-    if info != 0:
+    if (info != 0).any():
         raise RuntimeError("The Gram matrix is not positive definite. "
                            "Try increasing 'alpha'.")
     x = torch.cholesky_solve(rhs, L)
@@ -23,24 +23,23 @@ def initialize_code(x, weight, alpha, mode, rng: torch.Generator):
     wherein D is the dictionary and A is the code.
 
     Args:
-        x: data
-        weight: dictionary
+        x: data. Leading batch dimensions are supported: (*, n_samples, n_features)
+        weight: dictionary. (*, n_features, n_components)
         alpha: small eps term on diagonal for ridge initialization
         mode: code initialization method
         rng: torch.Generator for random initialization modes
     Returns:
 
     """
-    n_samples = x.size(0)
-    n_components = weight.size(1)
+    code_shape = x.shape[:-1] + (weight.size(-1),)
     if mode == 'zero':
-        z0 = x.new_zeros(n_samples, n_components)
+        z0 = x.new_zeros(code_shape)
     elif mode == 'unif':
-        z0 = x.new(n_samples, n_components).uniform_(-0.1, 0.1, generator=rng)
+        z0 = x.new(code_shape).uniform_(-0.1, 0.1, generator=rng)
     elif mode == 'transpose':
         z0 = torch.matmul(x, weight)
     elif mode == 'ridge':
-        z0 = ridge(x.T, weight, alpha=alpha).T
+        z0 = ridge(x.mT, weight, alpha=alpha).mT
     else:
         raise ValueError("invalid init parameter '{}'.".format(mode))
 
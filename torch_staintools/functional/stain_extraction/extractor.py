@@ -18,12 +18,12 @@ class BaseExtractor(ABC, Callable):
     def normalize_matrix_rows(A: torch.Tensor) -> torch.Tensor:
         """Normalize the rows of an array.
         Args:
-            A: An array to normalize
+            A: An array to normalize. Leading batch dimensions are supported.
 
         Returns:
             Array with rows normalized.
         """
-        return A / torch.linalg.norm(A, dim=1)[:, None]
+        return A / torch.linalg.norm(A, dim=-1, keepdim=True)
 
     @staticmethod
     @abstractmethod
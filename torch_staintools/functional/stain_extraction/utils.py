@@ -4,12 +4,16 @@ import torch
 def percentile(t: torch.Tensor, q: float, dim: int) -> torch.Tensor:
     """Author: adapted from https://gist.github.com/spezold/42a451682422beb42bc43ad0c0967a30
 
-    Return the ``q``-th percentile of the flattenepip d input tensor's data.
+    Return the ``q``-th percentile of the input tensor's data along the dimension ``dim``.
 
     CAUTION:
      * Needs PyTorch >= 1.1.0, as ``torch.kthvalue()`` is used.
      * Values are not interpolated, which corresponds to
        ``numpy.percentile(..., interpolation="nearest")``.
+     * Selection (``torch.kthvalue()``) rather than a full sort is performed, i.e., O(n) instead of O(n log n).
+     * On CUDA, ``torch.topk()`` is used instead, since its radix-select kernel parallelizes better than
+       ``kthvalue``. The smaller of the two tails is selected so that ``k`` stays small, e.g., the 99th percentile
+       only retrieves the top 1% of values. The result is identical to the ``kthvalue`` path.
 
     Args:
         t:  Input tensor.
@@ -17,12 +21,39 @@ def percentile(t: torch.Tensor, q: float, dim: int) -> torch.Tensor:
         dim: which dim to operate for function `tensor.kthvalue`.
 
     Returns:
-        Resulting value (scalar).
+        Resulting value, with the dimension ``dim`` reduced.
     """
+    assert 0 <= q <= 100, f"Percentile must be in [0, 100]. Got {q}"
+    n = t.shape[dim]
+    assert n > 0, f"Empty input along dim {dim}"
     # Note that ``kthvalue()`` works one-based, i.e. the first sorted value
     # indeed corresponds to k=1, not k=0! Use float(q) instead of q directly,
     # so that ``round()`` returns an integer, even if q is a np.float32.
-    k = 1 + round(.01 * float(q) * (t.shape[dim] - 1))  # interpolation?
-    return t.kthvalue(k, dim=dim).values
+    k = 1 + round(.01 * float(q) * (n - 1))  # interpolation?
+    # guard the extremes (q = 0 or 100) against any rounding out of [1, n]
+    k = min(max(k, 1), n)
+    if not t.is_cuda:
+        return t.kthvalue(k, dim=dim).values
+    return _kth_smallest_topk(t, k, dim)
+
+
+def _kth_smallest_topk(t: torch.Tensor, k: int, dim: int) -> torch.Tensor:
+    """The ``k``-th (one-based) smallest value along ``dim`` by ``torch.topk()`` on the shorter tail.
+
+    Equivalent to ``t.kthvalue(k, dim=dim).values``.
+
+    Args:
+        t: Input tensor.
+        k: one-based order of the value, in [1, n] with n = t.shape[dim].
+        dim: which dim to select from.
+
+    Returns:
+        Resulting value, with the dimension ``dim`` reduced.
+    """
+    n = t.shape[dim]
+    # the k-th smallest is the (n - k + 1)-th largest. select from whichever tail is shorter.
+    largest = k > n // 2
+    k_tail = n - k + 1 if largest else k
+    return t.topk(k_tail, dim=dim, largest=largest, sorted=True).values.select(dim, -1)
 
 
@@ -48,23 +48,37 @@ class VahadaneExtractor(BaseExtractor):
         # B x (H*W) x C
         od_flatten = od.flatten(start_dim=2, end_dim=-1).permute(0, 2, 1)
 
-        out_dict_list = list()
-        for od_single, mask_single in zip(od_flatten, tissue_mask_flatten):
-            x = od_single[mask_single]
+        if device.type == 'cpu':
+            # the padded batch iterates until the slowest image converges, which costs more than it saves on CPU.
+            dictionary = torch.stack([
+                dict_learning(od_single[mask_single], n_components=num_stains, alpha=regularizer, lambd=lambd,
+                              algorithm=algorithm, device=device, steps=steps,
+                              constrained=constrained, progbar=False, persist=True, init=init,
+                              verbose=verbose, rng=rng)[0]
+                for od_single, mask_single in zip(od_flatten, tissue_mask_flatten)])
+        else:
+            # pad the tissue pixels of each image into B x N x C with zero rows, N the max # of tissue pixels.
+            # stable sort moves the tissue pixels to the front while preserving their order.
+            order = torch.argsort((~tissue_mask_flatten).to(torch.uint8), dim=1, stable=True)
+            num_tissue = tissue_mask_flatten.sum(dim=1)
+            num_pixels = int(num_tissue.max())
+            order = order[:, :num_pixels]
+            mask_padded = torch.gather(tissue_mask_flatten, 1, order)
+            x = torch.gather(od_flatten, 1, order.unsqueeze(-1).expand(-1, -1, od_flatten.size(-1)))
+            x = x * mask_padded.unsqueeze(-1)
+            # all images are solved at once: B x C x num_stains
             # todo add num_stains here
             dictionary, losses = dict_learning(x, n_components=num_stains, alpha=regularizer, lambd=lambd,
                                                algorithm=algorithm, device=device, steps=steps,
                                                constrained=constrained, progbar=False, persist=True, init=init,
-                                               verbose=verbose, rng=rng)
+                                               verbose=verbose, rng=rng, num_samples=num_tissue)
         # H on first row.
-            dictionary = dictionary.T
-            # todo add num_stains here - sort?
-            # if dictionary[0, 0] < dictionary[1, 0]:
-            #     dictionary = dictionary[[1, 0], :]
-            dictionary, _ = torch.sort(dictionary, dim=0, descending=True)
-            out_dict_list.append(VahadaneExtractor.normalize_matrix_rows(dictionary))
-        # breakpoint()
-        return torch.stack(out_dict_list)
+        dictionary = dictionary.mT
+        # todo add num_stains here - sort?
+        # if dictionary[0, 0] < dictionary[1, 0]:
+        #     dictionary = dictionary[[1, 0], :]
+        dictionary, _ = torch.sort(dictionary, dim=-2, descending=True)
+        return VahadaneExtractor.normalize_matrix_rows(dictionary)
 
     @classmethod
     def __call__(cls, image: torch.Tensor, *, luminosity_threshold: float = 0.8,
@@ -1,5 +1,6 @@
 import torch
 from typing import Tuple, Optional
+from contextlib import contextmanager
 
 
 def transpose_trailing(mat: torch.Tensor):
@@ -9,15 +10,16 @@ def transpose_trailing(mat: torch.Tensor):
         mat: input tensor ixjxk
 
     Returns:
-        output with flipped dimension from ixjxk --> ixkxj
+        output with flipped dimension from ixjxk --> ixkxj. It is a view of the input (no copies).
     """
     assert mat.ndimension() == 3
-    return torch.einsum("ijk -> ikj", mat)
+    return mat.transpose(-1, -2)
 
 
 def img_from_concentration(concentration: torch.Tensor,
                            stain_matrix: torch.Tensor, img_shape: Tuple[int, ...],
-                           out_range: Tuple[float, float] = (0, 1)):
+                           out_range: Tuple[float, float] = (0, 1),
+                           autocast_dtype: Optional[torch.dtype] = None):
     """reconstruct image from concentration and stain matrix to RGB
 
     Args:
@@ -25,12 +27,18 @@ def img_from_concentration(concentration: torch.Tensor,
         stain_matrix: B x num_stain x input channel
         img_shape:
         out_range:
+        autocast_dtype: If specified (e.g., torch.bfloat16), the matmul runs under torch.autocast of this dtype.
+            None (default) means no autocast.
 
     Returns:
-
+        reconstructed image in the dtype of concentration, even if the matmul is computed under autocast.
     """
-    out = torch.exp(-1 * torch.matmul(concentration, stain_matrix))
-    out = transpose_trailing(out)
+    # B x C x (HW) directly so that no transpose is needed before reshaping to BCHW.
+    with torch.autocast(device_type=concentration.device.type, dtype=autocast_dtype,
+                        enabled=autocast_dtype is not None):
+        out = torch.matmul(transpose_trailing(stain_matrix), transpose_trailing(concentration))
+    # the matmul output is a fresh tensor so negation and exp can be done in-place.
+    out = out.to(concentration.dtype).neg_().exp_()
     return out.reshape(img_shape).clamp_(*out_range)
 
 
@@ -92,3 +100,23 @@ def nanstd(data: torch.Tensor, dim: Optional[int | tuple] = None,
     sum_dev2 = ((data - mean) ** 2).nansum(dim=dim,  keepdim=True)
     # sqrt and normalize by corrected degrees of freedom
     return torch.sqrt(sum_dev2 / (non_nan_count - correction))
+
+
+@contextmanager
+def allow_tf32(enabled: bool = True):
+    """Context manager to temporarily enable/disable the TF32 tensor cores for CUDA float32 matmul.
+
+    The previous setting is restored on exit. No effect on CPU.
+
+    Args:
+        enabled: whether to allow TF32 within the context.
+
+    Returns:
+
+    """
+    prev = torch.backends.cuda.matmul.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = enabled
+    try:
+        yield
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = prev
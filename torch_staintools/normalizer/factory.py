@@ -27,6 +27,8 @@ class NormalizerBuilder:
               cache_size_limit: int = -1,
               device: Optional[torch.device] = None,
               load_path: Optional[str] = None,
+              autocast_dtype: Optional[torch.dtype] = None,
+              warm_start: bool = False,
               ) -> Normalizer:
         """build from specified algorithm name `method`.
 
@@ -57,6 +59,11 @@ class NormalizerBuilder:
                 to `macenko` and 'vahadane'
             load_path: If specified, then stain matrix cache will be loaded from the file path. See the `cache`
                 module for more details. Only applies  to `macenko` and 'vahadane'
+            autocast_dtype: If specified (e.g., torch.bfloat16), the matmul of the image reconstruction runs under
+                torch.autocast of this dtype. None means no autocast. Only applies to `macenko` and 'vahadane'
+            warm_start: whether to initialize the concentration solver by the solution of the last transform call,
+                if the source stain matrices and the input shape are identical. Only applies to `macenko` and
+                'vahadane'
 
         Returns:
 
@@ -74,6 +81,8 @@ class NormalizerBuilder:
                                              rng=rng,
                                              cache_size_limit=cache_size_limit,
                                              device=device,
-                                             load_path=load_path)
+                                             load_path=load_path,
+                                             autocast_dtype=autocast_dtype,
+                                             warm_start=warm_start)
             case _:
                 raise NotImplementedError(f"{method} not implemented.")
@@ -31,6 +31,10 @@ class StainSeparation(Normalizer):
     regularizer: float
     rng: torch.Generator
     concentration_method: METHOD_FACTORIZE
+    autocast_dtype: Optional[torch.dtype]
+    warm_start: bool
+    _last_z0: Optional[torch.Tensor]
+    _last_stain_matrix: Optional[torch.Tensor]
 
     def __init__(self, get_stain_matrix: BaseExtractor, concentration_method: METHOD_FACTORIZE = 'ista',
                  num_stains: int = 2,
@@ -38,7 +42,9 @@ class StainSeparation(Normalizer):
                  regularizer: float = 0.1,
                  rng: Optional[int | torch.Generator] = None,
                  cache: Optional[TensorCache] = None,
-                 device: Optional[torch.device] = None):
+                 device: Optional[torch.device] = None,
+                 autocast_dtype: Optional[torch.dtype] = None,
+                 warm_start: bool = False):
         """Init
 
         Warnings:
@@ -49,8 +55,8 @@ class StainSeparation(Normalizer):
             get_stain_matrix: the Callable to obtain stain matrix - e.g., Vahadane's dict learning or
                 macenko's SVD
             concentration_method:  How to get stain concentration from stain matrix and OD through factorization.
-                support 'ista', 'cd', and 'ls'. 'ls' simply solves the least square problem for factorization of
-                min||HExC - OD|| but is faster. 'ista'/cd enforce the sparse penalty but slower.
+                support 'ista', 'fista', 'cd', and 'ls'. 'ls' simply solves the least square problem for factorization
+                of min||HExC - OD|| but is faster. 'ista'/'fista'/cd enforce the sparse penalty but slower.
                 'ls' may fail on individual large image due to resource limit.
             num_stains: number of stains to separate. For macenko only 2 is supported.
                 In general cases it is recommended to set num_stains as 2.
@@ -58,8 +64,19 @@ class StainSeparation(Normalizer):
                 as tissue.
             regularizer: Regularizer term in dict learning. Note that similar to staintools, for image
                 reconstruction step, we also use dictionary learning to get the target stain concentration.
+            autocast_dtype: If specified (e.g., torch.bfloat16), the matmul of the image reconstruction after the
+                concentration is solved runs under torch.autocast of this dtype, at the cost of precision.
+                None (default) means no autocast.
+            warm_start: If True, the source concentration computed in the last `transform` call is cached and used
+                as the initialization of the sparse solver in the next call, if the source stain matrices and
+                the input shape are identical. Otherwise, the solver is initialized by the ridge solution.
         """
         super().__init__(cache=cache, device=device, rng=rng)
+        self.autocast_dtype = autocast_dtype
+        self.warm_start = warm_start
+        # not exported to the state_dict.
+        self.register_buffer('_last_z0', None, persistent=False)
+        self.register_buffer('_last_stain_matrix', None, persistent=False)
         self.concentration_method = concentration_method
         self.get_stain_matrix = get_stain_matrix
         self.num_stains = num_stains
@@ -91,7 +108,7 @@ class StainSeparation(Normalizer):
 
         self.register_buffer('stain_matrix_target', stain_matrix_target)
         target_conc = get_concentrations(target, self.stain_matrix_target, regularizer=self.regularizer,
-                                         algorithm='ista', rng=self.rng)
+                                         algorithm='fista', rng=self.rng)
         self.register_buffer('target_concentrations', target_conc)
         # B x (HW) x 2
         conc_transpose = transpose_trailing(self.target_concentrations)
@@ -109,11 +126,30 @@ class StainSeparation(Normalizer):
             image: input batch image
 
         Returns:
-            repeated stain matrix
+            repeated stain matrix as an expanded view (no copies) along the batch dimension. In-place
+            operations should be avoided on the output as all batch items share the same memory.
         """
         stain_mat = torch.atleast_3d(stain_mat)
-        repeat_dim = (image.shape[0],) + (1,) * (stain_mat.ndimension() - 1)
-        return stain_mat.repeat(*repeat_dim)
+        return stain_mat.expand(image.shape[0], *stain_mat.shape[-2:])
+
+    def _warm_start_code(self, stain_matrix_source: torch.Tensor, image: torch.Tensor) -> Optional[torch.Tensor]:
+        """Get the cached concentration of the last transform as the initialization of the solver.
+
+        Args:
+            stain_matrix_source: source stain matrices of the current input. B x num_stains x C
+            image: current input. B x C x H x W
+
+        Returns:
+            The cached concentration (B x num_stains x HW) if warm start is enabled and the cache matches the current
+            stain matrices and input shape. Otherwise, None. Always None for 'ls', which takes no initialization.
+        """
+        if not self.warm_start or self.concentration_method == 'ls' or self._last_z0 is None:
+            return None
+        expected_shape = (image.shape[0], stain_matrix_source.shape[-2], image.shape[-2] * image.shape[-1])
+        if self._last_z0.shape != expected_shape or not torch.equal(self._last_stain_matrix.to(stain_matrix_source),
+                                                                     stain_matrix_source):
+            return None
+        return self._last_z0
 
     def transform(self, image: torch.Tensor,
                   cache_keys: Optional[List[Hashable]] = None, **stain_mat_kwargs) -> torch.Tensor:
@@ -154,8 +190,13 @@ class StainSeparation(Normalizer):
         if stain_matrix_source.shape[0] != image.shape[0] and stain_matrix_source.shape[0] == 1:
             stain_matrix_source = StainSeparation.repeat_stain_mat(stain_matrix_source, image)
         # B * 2 * (HW)
+        z0 = self._warm_start_code(stain_matrix_source, image)
         source_concentration = get_concentrations(image, stain_matrix_source, algorithm=self.concentration_method,
-                                                  regularizer=self.regularizer, rng=self.rng)
+                                                  regularizer=self.regularizer, rng=self.rng, z0=z0)
+        if self.warm_start and self.concentration_method != 'ls':
+            # copy --> the source_concentration is scaled in-place below.
+            self._last_z0 = source_concentration.detach().clone()
+            self._last_stain_matrix = stain_matrix_source.detach()
         # individual shape (2,) (HE)
         # note that c_transposed_src is just a view of source_concentration and therefore any inplace operation on
         # them will be reflected to each other, but this should be avoided for better readability
@@ -165,8 +206,9 @@ class StainSeparation(Normalizer):
         c_scale = transpose_trailing((self.maxC_target / maxC).unsqueeze(-1))
 
         c_transposed_src *= c_scale
-        # note this is the reconstruction in B x (HW) x C --> need to shuffle the channel first before reshape
-        return img_from_concentration(c_transposed_src, self.stain_matrix_target, image.shape, (0, 1))
+        # the reconstruction is computed in B x C x (HW) so that it reshapes to BCHW directly.
+        return img_from_concentration(c_transposed_src, self.stain_matrix_target, image.shape, (0, 1),
+                                      autocast_dtype=self.autocast_dtype)
 
     def forward(self, x: torch.Tensor,
                 cache_keys: Optional[List[Hashable]] = None,  **stain_mat_kwargs) -> torch.Tensor:
@@ -194,7 +236,9 @@ class StainSeparation(Normalizer):
               use_cache: bool = False,
               cache_size_limit: int = -1,
               device: Optional[torch.device] = None,
-              load_path: Optional[str] = None
+              load_path: Optional[str] = None,
+              autocast_dtype: Optional[torch.dtype] = None,
+              warm_start: bool = False,
               ) -> "StainSeparation":
         """Builder.
 
@@ -214,6 +258,10 @@ class StainSeparation(Normalizer):
             device: what device to hold the cache and the normalizer. If none the device is set to cpu.
             load_path: If specified, then stain matrix cache will be loaded from the file path. See the `cache`
                 module for more details.
+            autocast_dtype: If specified (e.g., torch.bfloat16), the matmul of the image reconstruction runs under
+                torch.autocast of this dtype. None means no autocast.
+            warm_start: whether to initialize the concentration solver by the solution of the last transform call,
+                if the source stain matrices and the input shape are identical.
 
         Returns:
             StainSeparation normalizer.
@@ -224,4 +272,4 @@ class StainSeparation(Normalizer):
                                 load_path=load_path)
         return cls(extractor, concentration_method=concentration_method, num_stains=num_stains,
                    luminosity_threshold=luminosity_threshold, regularizer=regularizer, rng=rng,
-                   cache=cache, device=device).to(device)
+                   cache=cache, device=device, autocast_dtype=autocast_dtype, warm_start=warm_start).to(device)